@@ -18,8 +18,7 @@
           let
             python-env = pkgs.python3.withPackages (ps: [
               ps.babel
-              ps.dateutil
-              ps.pyyaml
+              ps.orjson
               ps.requests
               ps.rich
             ]);
@@ -1,45 +1,200 @@
-import sys, json, subprocess
-import base64, argparse
-from dateutil.parser import parse
+import os, re, sys, time, tempfile, subprocess
+import base64, argparse, hashlib, operator
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, UTC
-from babel.dates import format_timedelta
-import requests
+import orjson
 from rich import print, box
-from rich.table import Table
+from rich.table import Table, Column
 from rich.text import Text
 from rich.style import Style
 
+NOW = datetime.now(UTC)
+
+format_timedelta = None
+
 def date_ago(date):
-    now = datetime.now(UTC)
-    date = parse(date) - now
+    # Imported lazily because babel is slow to load.
+    global format_timedelta
+    if format_timedelta is None:
+        from babel.dates import format_timedelta
+    # GitHub dates are always ISO 8601, which `fromisoformat` parses since python 3.11.
+    date = datetime.fromisoformat(date) - NOW
     return format_timedelta(date, add_direction=True)
 
+CACHE_DIR = os.path.join(os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache'), 'github-status')
+
+def read_cache(name):
+    try:
+        with open(os.path.join(CACHE_DIR, name), 'rb') as f:
+            return orjson.loads(f.read())
+    except (OSError, ValueError):
+        return None
+
+# The cache is best-effort: if it can't be written we just carry on with the fetched data.
+def write_cache(name, data):
+    try:
+        # The cache holds private data, keep it readable only by the user.
+        os.makedirs(CACHE_DIR, mode=0o700, exist_ok=True)
+        os.chmod(CACHE_DIR, 0o700)
+        # Write atomically so that concurrent runs never read a partial file. `mkstemp` creates
+        # the file with mode 0600.
+        fd, tmp_path = tempfile.mkstemp(dir=CACHE_DIR, prefix=f".{name}.")
+    except OSError:
+        return
+    try:
+        with open(fd, 'wb') as f:
+            f.write(orjson.dumps(data))
+        os.replace(tmp_path, os.path.join(CACHE_DIR, name))
+    except BaseException as e:
+        try:
+            os.unlink(tmp_path)
+        except OSError:
+            pass
+        if not isinstance(e, OSError):
+            raise
+
+def remove_cache(name):
+    try:
+        os.unlink(os.path.join(CACHE_DIR, name))
+    except OSError:
+        pass
+
+# Raised when GitHub rejects our token.
+class Unauthorized(Exception):
+    pass
+
 def github_api(token, endpoint, json=None):
-    headers = {"Authorization": f"Bearer {token}"}
+    # Responses are cached along with what GitHub tells us about when we may
+    # query it again: the poll interval, and the rate limit reset time once the
+    # limit is exhausted. Within that window we don't touch the network at all.
+    # Where supported we also make conditional requests: a `304 Not Modified`
+    # answer doesn't count against the rate limit.
+    key = orjson.dumps([token, endpoint, json])
+    cache_name = f"{endpoint.replace('/', '-')}-{hashlib.sha256(key).hexdigest()}.json"
+    headers = {}
+    now = time.time()
+    if cache := read_cache(cache_name):
+        if now < cache['fetched_at'] + cache['poll_interval'] or now < cache['rate_limit_reset']:
+            return cache['body']
+        if cache['last_modified']:
+            headers["If-Modified-Since"] = cache['last_modified']
+    # Only load `requests` when we actually hit the network.
+    import requests
+    headers["Authorization"] = f"Bearer {token}"
     if json:
         response = requests.post(f"https://api.github.com/{endpoint}", json=json, headers=headers)
     else:
         response = requests.get(f"https://api.github.com/{endpoint}", headers=headers)
-    if response.status_code == 200:
-        return response.json()
+    if response.status_code == 304 and cache:
+        body = cache['body']
+    elif response.status_code == 200:
+        body = orjson.loads(response.content)
+    elif response.status_code == 401:
+        raise Unauthorized("Query failed to run by returning code of 401. {}".format(response.text))
     else:
         raise Exception("Query failed to run by returning code of {}. {}".format(response.status_code, response.text))
+    rate_limit_reset = 0
+    if response.headers.get('X-RateLimit-Remaining') == '0':
+        rate_limit_reset = int(response.headers.get('X-RateLimit-Reset', 0))
+    last_modified = response.headers.get('Last-Modified', cache and cache['last_modified'])
+    poll_interval = int(response.headers.get('X-Poll-Interval', 0))
+    # Only keep responses we may be able to reuse. In practice GraphQL responses are only kept
+    # while the rate limit is exhausted.
+    if last_modified or poll_interval or rate_limit_reset:
+        write_cache(cache_name, {
+            'body': body,
+            'last_modified': last_modified,
+            'poll_interval': poll_interval,
+            'rate_limit_reset': rate_limit_reset,
+            'fetched_at': now,
+        })
+    elif cache:
+        remove_cache(cache_name)
+    return body
+
+# How long to trust the token returned by `gh auth token`.
+TOKEN_TTL = 3600
+
+def gh_hosts_mtime():
+    config_dir = os.environ.get('GH_CONFIG_DIR') or os.path.join(
+        os.environ.get('XDG_CONFIG_HOME') or os.path.expanduser('~/.config'), 'gh')
+    try:
+        return os.stat(os.path.join(config_dir, 'hosts.yml')).st_mtime
+    except OSError:
+        return None
+
+# The cache is dropped when gh's hosts file changes (`gh auth login/logout/switch/refresh`), or
+# with `refresh=True` when GitHub rejected the cached token.
+def gh_auth_token(refresh=False):
+    # Same precedence as gh itself; nothing to cache there.
+    if token := os.environ.get('GH_TOKEN') or os.environ.get('GITHUB_TOKEN'):
+        return token
+    hosts_mtime = gh_hosts_mtime()
+    cache = read_cache("token.json")
+    if not refresh and cache and cache.get('hosts_mtime') == hosts_mtime \
+            and time.time() < cache['fetched_at'] + TOKEN_TTL:
+        return cache['token']
+    out = subprocess.run(["gh", "auth", "token"], capture_output=True)
+    assert out.returncode == 0
+    token = out.stdout.decode('utf-8').strip()
+    write_cache("token.json", {'token': token, 'hosts_mtime': hosts_mtime, 'fetched_at': time.time()})
+    return token
+
+def git_head_mtime():
+    path = os.getcwd()
+    while True:
+        git = os.path.join(path, '.git')
+        if os.path.isfile(git):
+            # Worktrees and submodules point to their git dir from a `.git` file.
+            try:
+                with open(git) as f:
+                    git = os.path.join(path, f.read().removeprefix('gitdir:').strip())
+            except OSError:
+                return None
+        try:
+            return os.stat(os.path.join(git, 'HEAD')).st_mtime
+        except OSError:
+            pass
+        parent = os.path.dirname(path)
+        if parent == path:
+            return None
+        path = parent
+
+# Owner of the repo in the current directory. Cached per directory until the git HEAD changes.
+def current_repo_owner():
+    cwd = os.getcwd()
+    head_mtime = git_head_mtime()
+    cache = read_cache("repos.json") or {}
+    if (entry := cache.get(cwd)) and entry['head_mtime'] == head_mtime:
+        return entry['owner']
+    out = subprocess.run(["gh", "repo", "view", "--json", "owner"], capture_output=True)
+    if out.returncode != 0:
+        return None
+    owner = orjson.loads(out.stdout)['owner']['login']
+    cache[cwd] = {'head_mtime': head_mtime, 'owner': owner}
+    write_cache("repos.json", cache)
+    return owner
 
 def run_graphql_query(token, query):
     return github_api(token, 'graphql', {'query': query})
 
 FRAGMENT_COMMON = """
-  author { login }
-  labels(first: 20) {
-    nodes { name }
-  }
   number
   repository {
       owner { login }
       name
-      nameWithOwner
   }
-  timelineItems(itemTypes: CROSS_REFERENCED_EVENT, last: 20) {
+  title
+  updatedAt
+  url
+"""
+
+# Fields used by the assigned items table, for both issues and PRs.
+FRAGMENT_TRACKING = """
+  labels(first: 10) {
+    nodes { name }
+  }
+  timelineItems(itemTypes: CROSS_REFERENCED_EVENT, last: 5) {
     nodes {
       ... on CrossReferencedEvent {
         willCloseTarget
@@ -52,14 +207,17 @@ FRAGMENT_COMMON = """
       }
     }
   }
-  title
-  updatedAt
-  url
 """
 
 FRAGMENT_ISSUE = """
 fragment Issue on Issue {
-  """ + FRAGMENT_COMMON + """
+  """ + FRAGMENT_COMMON + FRAGMENT_TRACKING + """
+}
+"""
+
+FRAGMENT_ASSIGNED_PR = """
+fragment AssignedPR on PullRequest {
+  """ + FRAGMENT_COMMON + FRAGMENT_TRACKING + """
 }
 """
 
@@ -84,7 +242,6 @@ fragment PR on PullRequest {
       state
     }
   }
-  reviewDecision
   reviewRequests(last: 1) {
     nodes {
       requestedReviewer {
@@ -97,104 +254,116 @@ fragment PR on PullRequest {
 }
 """
 
-def search_query(search):
+def search_query(search, fields):
     return """
         search(first: 100, type: ISSUE, query: \""""+search+"""\") {
           nodes {
-            ... on PullRequest {
-                ...PR
-            }
-            ... on Issue {
-                ...Issue
-            }
+            """+fields+"""
           }
         }
     """
 
-# Used to construct a notification token
-MAGIC_BITS = b'\x93\x00\xCE\x00\x67\x82\xa6\xb3'
-def report_notifications(rows, user_id, orgs=set()):
-    rows.sort(key = lambda row: row['updated_at'])
+# Styles are immutable, so rows can share them.
+DIM = Style(dim=True)
+
+def link(text, url):
+    return Text(text, style=Style(link=url))
 
-    table = Table(title="Notifications", box=box.SIMPLE)
-    table.add_column("Repo")
-    table.add_column("Title")
-    table.add_column("Type")
-    table.add_column("Reason")
-    table.add_column("Updated", style="bright_black")
-    table.add_column("Token")
+# Turns an API url into the corresponding web url.
+API_URL_REWRITES = {"api.": "", "repos/": "", "pulls": "pull"}
+API_URL_RE = re.compile("|".join(re.escape(pattern) for pattern in API_URL_REWRITES))
 
+def render_table(title, rows, columns, row_style=None):
+    # `columns` is a list of `(column, accessor)` pairs, where `column` is a
+    # header or a `Column` and `accessor` computes the cell from a row.
+    table = Table(*(column for column, _ in columns), title=title, box=box.SIMPLE)
+    accessors = [accessor for _, accessor in columns]
+    add_row = table.add_row
     for row in rows:
-        if row['repository']['owner']['login'] not in orgs:
-            continue
-        url = row['subject']['url'].replace("api.", "").replace("repos/", "").replace("pulls", "pull")
-        notification_token = base64.b64encode(MAGIC_BITS + f"{row['id']}:{user_id}".encode()).decode().rstrip('=')
-        url = url + f"?notification_referrer_id=NT_{notification_token}"
-        table.add_row(
-            row['repository']['name'],
-            Text(row['subject']['title'], style=Style(link=url)),
-            row['subject']['type'],
-            row['reason'],
-            date_ago(row['updated_at']),
-            notification_token,
+        add_row(
+            *(accessor(row) for accessor in accessors),
+            style=row_style(row) if row_style else None,
         )
     return table
 
-def report_open_prs(data):
-    rows = data['nodes']
-    rows.sort(key = lambda row: row['updatedAt'])
+def repo_name(row):
+    return row['repository']['name']
+
+def title_link(row):
+    return link(row['title'], row['url'])
+
+def updated(row):
+    return date_ago(row['updatedAt'])
 
-    table = Table(title="Open PRs", box=box.SIMPLE)
-    table.add_column("Repo")
-    table.add_column("Number")
-    table.add_column("CI")
-    table.add_column("Review")
-    table.add_column("Title")
-    table.add_column("Branch", style="cyan")
-    table.add_column("Updated", style="bright_black")
+# Used to construct a notification token
+MAGIC_BITS = b'\x93\x00\xCE\x00\x67\x82\xa6\xb3'
+def report_notifications(rows, user_id, orgs=set()):
+    if orgs:
+        rows = [row for row in rows if row['repository']['owner']['login'] in orgs]
+    rows.sort(key = operator.itemgetter('updated_at'))
 
+    user_id_suffix = f":{user_id}".encode()
     for row in rows:
-        ci_status = "✅"
-        if rolledup_status := row['commits']['nodes'][0]['commit']['statusCheckRollup']:
-            rolledup_status = rolledup_status['state']
-            if row['mergeable'] != 'MERGEABLE':
-                ci_status = "❌"
-            elif rolledup_status == 'PENDING':
-                ci_status = "🟡"
-            elif rolledup_status != 'SUCCESS':
-                ci_status = "❌"
-        else:
-            ci_status = "❔"
+        url = API_URL_RE.sub(lambda m: API_URL_REWRITES[m.group(0)], row['subject']['url'])
+        notification_token = base64.b64encode(MAGIC_BITS + row['id'].encode() + user_id_suffix).decode().rstrip('=')
+        row['token'] = notification_token
+        row['link'] = link(row['subject']['title'], url + f"?notification_referrer_id=NT_{notification_token}")
 
-        review_status = "❔"
-        if row['isDraft']:
-            review_status = ""
-        if row['reviewDecision'] == 'APPROVED':
-            review_status = "✅"
+    return render_table("Notifications", rows, [
+        ("Repo", repo_name),
+        ("Title", operator.itemgetter('link')),
+        ("Type", lambda row: row['subject']['type']),
+        ("Reason", operator.itemgetter('reason')),
+        (Column("Updated", style="bright_black"), lambda row: date_ago(row['updated_at'])),
+        ("Token", operator.itemgetter('token')),
+    ])
+
+def ci_status(row):
+    if rolledup_status := row['commits']['nodes'][0]['commit']['statusCheckRollup']:
+        rolledup_status = rolledup_status['state']
+        if row['mergeable'] != 'MERGEABLE':
+            return "❌"
+        elif rolledup_status == 'PENDING':
+            return "🟡"
+        elif rolledup_status != 'SUCCESS':
+            return "❌"
+        return "✅"
+    else:
+        return "❔"
+
+def review_status(row):
+    review_status = "❔"
+    if row['isDraft']:
+        review_status = ""
+    if row['reviewDecision'] == 'APPROVED':
+        review_status = "✅"
+    else:
+        reviews = row['latestReviews']['nodes']
+        if len(reviews) == 0:
+            review_requests = row['reviewRequests']['nodes']
+            if len(review_requests) != 0:
+                review_status = "🟡"
         else:
-            reviews = row['latestReviews']['nodes']
-            if len(reviews) == 0:
-                review_requests = row['reviewRequests']['nodes']
-                if len(review_requests) != 0:
-                    review_status = "🟡"
-            else:
-                state = reviews[0]['state']
-                if state == 'APPROVED':
-                    review_status = "✅"
-                elif state == 'CHANGES_REQUESTED':
-                    review_status = "❌"
-
-        number_color = "white" if row['isDraft'] else "green"
-        table.add_row(
-            row['repository']['name'],
-            Text(f"#{row['number']}", style=number_color),
-            ci_status,
-            review_status,
-            Text(row['title'], style=Style(link=row['url'])),
-            row['headRefName'],
-            date_ago(row['updatedAt']),
-        )
-    return table
+            state = reviews[0]['state']
+            if state == 'APPROVED':
+                review_status = "✅"
+            elif state == 'CHANGES_REQUESTED':
+                review_status = "❌"
+    return review_status
+
+def report_open_prs(data):
+    rows = data['nodes']
+    rows.sort(key = operator.itemgetter('updatedAt'))
+
+    return render_table("Open PRs", rows, [
+        ("Repo", repo_name),
+        ("Number", lambda row: Text(f"#{row['number']}", style="white" if row['isDraft'] else "green")),
+        ("CI", ci_status),
+        ("Review", review_status),
+        ("Title", title_link),
+        (Column("Branch", style="cyan"), operator.itemgetter('headRefName')),
+        (Column("Updated", style="bright_black"), updated),
+    ])
 
 def report_assigned(data):
     rows = data['nodes']
@@ -204,43 +373,25 @@ def report_assigned(data):
             for item in cross_refs['nodes']:
                 if item.get('willCloseTarget'):
                     number = f"#{item['source']['number']}"
-                    closing_pr = Text(number, style=Style(link=item['source']['url']))
+                    closing_pr = link(number, item['source']['url'])
         row['closing_pr'] = closing_pr
-        row['blocked'] = any('blocked' in l['name'] for l in row['labels']['nodes'])
+        row['label_names'] = ", ".join(l['name'] for l in row['labels']['nodes'])
+        # The separator can't create spurious matches, so a single scan of the joined names is enough.
+        row['blocked'] = 'blocked' in row['label_names']
+        row['sort_key'] = (closing_pr is None, not row['blocked'], row['updatedAt'])
 
-    rows.sort(key = lambda row: (row['closing_pr'] is None, not row['blocked'], row['updatedAt']))
+    rows.sort(key = operator.itemgetter('sort_key'))
 
-    table = Table(title="Assigned PRs and issues", box=box.SIMPLE)
-    table.add_column("Repo")
-    table.add_column("Number", style="green")
-    table.add_column("Title")
-    table.add_column("Fix", style="blue")
-    table.add_column("Labels")
-    table.add_column("Updated", style="bright_black")
-
-    for row in rows:
-        style = None
-        if row['closing_pr'] or row['blocked']:
-            style = Style(dim=True)
-        labels = row['labels']['nodes']
-        labels = ", ".join(l['name'] for l in labels)
-        table.add_row(
-            row['repository']['name'],
-            f"#{row['number']}",
-            Text(row['title'], style=Style(link=row['url'])),
-            row['closing_pr'],
-            labels,
-            date_ago(row['updatedAt']),
-            style=style,
-        )
-    return table
+    return render_table("Assigned PRs and issues", rows, [
+        ("Repo", repo_name),
+        (Column("Number", style="green"), lambda row: f"#{row['number']}"),
+        ("Title", title_link),
+        (Column("Fix", style="blue"), operator.itemgetter('closing_pr')),
+        ("Labels", operator.itemgetter('label_names')),
+        (Column("Updated", style="bright_black"), updated),
+    ], row_style=lambda row: DIM if row['closing_pr'] or row['blocked'] else None)
 
 if __name__ == "__main__":
-    # Retrieve the GitHub login token.
-    out = subprocess.run(["gh", "auth", "token"], capture_output=True)
-    assert out.returncode == 0
-    GITHUB_TOKEN = out.stdout.decode('utf-8').strip()
-
     parser = argparse.ArgumentParser(prog='github-status')
     parser.add_argument('--org', action='append',
                         help='filter everything for this organization. Can be supplied several times.')
@@ -251,25 +402,34 @@ if __name__ == "__main__":
     # Filter organizations
     orgs = args.org or []
     if args.auto_org:
-        out = subprocess.run(["gh", "repo", "view", "--json", "owner"], capture_output=True)
-        if out.returncode == 0:
-            json = json.loads(out.stdout)
-            orgs.append(json['owner']['login'])
+        if owner := current_repo_owner():
+            orgs.append(owner)
 
     # Fetch data
-    notifications = github_api(GITHUB_TOKEN, 'notifications')
-
     open_prs_query = "state:open author:@me is:pr"
     assigned_query = "state:open assignee:@me"
     for org in orgs:
         open_prs_query += f" org:{org}"
         assigned_query += f" org:{org}"
-    query = FRAGMENT_ISSUE + FRAGMENT_PR + f"""query {{
+    query = FRAGMENT_ISSUE + FRAGMENT_ASSIGNED_PR + FRAGMENT_PR + f"""query {{
         user: viewer {{ databaseId }}
-        open_prs: {search_query(open_prs_query)}
-        assigned: {search_query(assigned_query)}
+        open_prs: {search_query(open_prs_query, "... on PullRequest { ...PR }")}
+        assigned: {search_query(assigned_query, "... on PullRequest { ...AssignedPR } ... on Issue { ...Issue }")}
     }}"""
-    graphql_result = run_graphql_query(GITHUB_TOKEN, query)['data']
+    # Notifications are not exposed in the public GraphQL schema, so they have
+    # to come from the REST API. The two requests are independent, so run them
+    # concurrently to pay for a single round trip.
+    def fetch(token):
+        with ThreadPoolExecutor() as executor:
+            notifications = executor.submit(github_api, token, 'notifications')
+            graphql_result = executor.submit(run_graphql_query, token, query)
+            return notifications.result(), graphql_result.result()['data']
+
+    try:
+        notifications, graphql_result = fetch(gh_auth_token())
+    except Unauthorized:
+        # The cached token may have been revoked; ask gh again.
+        notifications, graphql_result = fetch(gh_auth_token(refresh=True))
 
     # Display
     user_id = graphql_result['user']['databaseId']